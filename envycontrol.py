@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import errno
+import functools
 import logging
 import os
 import re
 import subprocess
 import sys
+import time
 from contextlib import contextmanager
 
 # begin constants definition
@@ -14,6 +17,18 @@ VERSION = '3.5.2'
 # Note: Do NOT remove this in cleanup!
 CACHE_FILE_PATH = '/var/cache/envycontrol/cache.json'
 
+HISTORY_FILE_PATH = os.path.join(
+    os.path.dirname(CACHE_FILE_PATH), 'history.jsonl')
+
+# mode staged by the last switch and the boot it was staged in
+STAGED_FILE_PATH = os.path.join(
+    os.path.dirname(CACHE_FILE_PATH), 'staged.json')
+
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+# records kept per history file before it is rotated to HISTORY_FILE_PATH.1
+HISTORY_MAX_RECORDS = 500
+
 BLACKLIST_PATH = '/etc/modprobe.d/blacklist-nvidia.conf'
 
 BLACKLIST_CONTENT = '''# Automatically generated by EnvyControl
@@ -220,22 +235,51 @@ done
 SUPPORTED_MODES = ['integrated', 'hybrid', 'nvidia']
 SUPPORTED_DISPLAY_MANAGERS = ['gdm', 'gdm3', 'sddm', 'lightdm']
 RTD3_MODES = [0, 1, 2, 3]
+HISTORY_PHASES = ['probe', 'cleanup', 'write', 'systemd', 'initramfs']
+HISTORY_RECORD_KEYS = ['mode', 'durations', 'total', 'status', 'kernel']
+
+PCI_DEVICES_PATH = '/sys/bus/pci/devices'
+PROC_MODULES_PATH = '/proc/modules'
+NVIDIA_PCI_VENDOR = '0x10de'
+NVIDIA_KERNEL_MODULES = ['nvidia', 'nvidia_current']
+DRM_CLASS_PATH = '/sys/class/drm'
+
+# kernel uevent multicast group of the NETLINK_KOBJECT_UEVENT protocol
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+UEVENT_BUFFER_SIZE = 8192
+PCI_SLOT_NAME_PATTERN = r'^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]$'
+
+# BusID of the Nvidia Device section in XORG_INTEL and XORG_AMD
+XORG_NVIDIA_BUS_ID_PATTERN = r'(Section "Device"\s*\n\s*Identifier "nvidia"\s*\n(?:(?!\s*EndSection)[^\n]*\n)*?\s*BusID ")[^"]*(")'
 
 # end constants definition
 
 
+def timed_phase(phase):
+    # accumulate the runtime of the decorated function into a history phase
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with history.phase(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def graphics_mode_switcher(graphics_mode, user_display_manager, enable_force_comp, coolbits_value, rtd3_value, use_nvidia_current):
     print(f"Switching to {graphics_mode} mode")
 
     if graphics_mode == 'integrated':
 
-        if logging.getLogger().level == logging.DEBUG:
-            service = subprocess.run(
-                ["systemctl", "disable", "nvidia-persistenced.service"])
-        else:
-            service = subprocess.run(
-                ["systemctl", "disable", "nvidia-persistenced.service"],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with history.phase('systemd'):
+            if logging.getLogger().level == logging.DEBUG:
+                service = subprocess.run(
+                    ["systemctl", "disable", "nvidia-persistenced.service"])
+            else:
+                service = subprocess.run(
+                    ["systemctl", "disable", "nvidia-persistenced.service"],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         if service.returncode == 0:
             print('Successfully disabled nvidia-persistenced.service')
         else:
@@ -255,13 +299,14 @@ def graphics_mode_switcher(graphics_mode, user_display_manager, enable_force_com
             f"Enable PCI-Express Runtime D3 (RTD3) Power Management: {rtd3_value or False}")
         cleanup()
 
-        if logging.getLogger().level == logging.DEBUG:
-            service = subprocess.run(
-                ["systemctl", "enable", "nvidia-persistenced.service"])
-        else:
-            service = subprocess.run(
-                ["systemctl", "enable", "nvidia-persistenced.service"],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with history.phase('systemd'):
+            if logging.getLogger().level == logging.DEBUG:
+                service = subprocess.run(
+                    ["systemctl", "enable", "nvidia-persistenced.service"])
+            else:
+                service = subprocess.run(
+                    ["systemctl", "enable", "nvidia-persistenced.service"],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         if service.returncode == 0:
             print('Successfully enabled nvidia-persistenced.service')
         else:
@@ -286,13 +331,14 @@ def graphics_mode_switcher(graphics_mode, user_display_manager, enable_force_com
         print(f"Enable ForceCompositionPipeline: {enable_force_comp}")
         print(f"Enable Coolbits: {coolbits_value or False}")
 
-        if logging.getLogger().level == logging.DEBUG:
-            service = subprocess.run(
-                ["systemctl", "enable", "nvidia-persistenced.service"])
-        else:
-            service = subprocess.run(
-                ["systemctl", "enable", "nvidia-persistenced.service"],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with history.phase('systemd'):
+            if logging.getLogger().level == logging.DEBUG:
+                service = subprocess.run(
+                    ["systemctl", "enable", "nvidia-persistenced.service"])
+            else:
+                service = subprocess.run(
+                    ["systemctl", "enable", "nvidia-persistenced.service"],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         if service.returncode == 0:
             print('Successfully enabled nvidia-persistenced.service')
         else:
@@ -353,6 +399,7 @@ def graphics_mode_switcher(graphics_mode, user_display_manager, enable_force_com
     print('Please reboot your computer for changes to take effect!')
 
 
+@timed_phase('cleanup')
 def cleanup():
     # define list of files to remove
     to_remove = [
@@ -392,6 +439,7 @@ def cleanup():
         logging.info(f"Removed file {backup_path}")
 
 
+@timed_phase('probe')
 def get_nvidia_gpu_pci_bus():
     lspci_output = subprocess.check_output(['lspci']).decode('utf-8')
     for line in lspci_output.splitlines():
@@ -405,13 +453,20 @@ def get_nvidia_gpu_pci_bus():
         print("Try switching to hybrid mode first!")
         sys.exit(1)
 
+    return format_pci_bus_id(pci_bus_id)
+
+
+def format_pci_bus_id(pci_bus_id):
     # need to return the BusID in 'PCI:bus:device:function' format
     # also perform hexadecimal to decimal conversion
-    bus, device_function = pci_bus_id.split(":")
+    domain, bus, device_function = (['0'] + pci_bus_id.split(":"))[-3:]
     device, function = device_function.split(".")
+    if int(domain, 16) != 0:
+        return f"PCI:{int(bus, 16)}@{int(domain, 16)}:{int(device, 16)}:{int(function, 16)}"
     return f"PCI:{int(bus, 16)}:{int(device, 16)}:{int(function, 16)}"
 
 
+@timed_phase('probe')
 def get_igpu_vendor():
     lspci_output = subprocess.check_output(["lspci"]).decode('utf-8')
     for line in lspci_output.splitlines():
@@ -426,6 +481,7 @@ def get_igpu_vendor():
     return None
 
 
+@timed_phase('probe')
 def get_display_manager():
     try:
         with open('/etc/systemd/system/display-manager.service', 'r', encoding='utf-8') as f:
@@ -476,6 +532,7 @@ def get_amd_igpu_name():
         return None
 
 
+@timed_phase('initramfs')
 def rebuild_initramfs():
     # OSTree systems first
     if any(os.path.exists(dir) for dir in ['/ostree', '/sysroot/ostree']):
@@ -513,6 +570,7 @@ def rebuild_initramfs():
             logging.error("An error ocurred while rebuilding the initramfs")
 
 
+@timed_phase('write')
 def create_file(path, content, executable=False):
     try:
         # create the parent folders if needed
@@ -545,6 +603,8 @@ def main():
                         help='Output the current version')
     parser.add_argument('-q', '--query', action='store_true',
                         help='Query the current graphics mode')
+    parser.add_argument('--json', action='store_true',
+                        help='Output --query as JSON built from sysfs and /proc only, without waking the Nvidia dGPU')
     parser.add_argument('-s', '--switch', type=str, metavar='MODE', action='store', choices=SUPPORTED_MODES,
                         help='Switch the graphics mode. Available choices: %(choices)s')
     parser.add_argument('--dm', type=str, metavar='DISPLAY_MANAGER', action='store', choices=SUPPORTED_DISPLAY_MANAGERS,
@@ -567,6 +627,12 @@ def main():
                         help='Delete cache created by EnvyControl')
     parser.add_argument('--cache-query', action='store_true',
                         help='Show cache created by EnvyControl')
+    parser.add_argument('--holders', action='store_true',
+                        help='List processes holding the Nvidia dGPU open and keeping it out of runtime suspend')
+    parser.add_argument('--watch-hotplug', action='store_true',
+                        help='Follow Nvidia GPU hotplug events (eGPUs, docks) and update the cached BusID and Xorg config')
+    parser.add_argument('--history', action='store_true',
+                        help='Show p50/p95 durations of past operations per mode and phase')
     parser.add_argument('--verbose', default=False, action='store_true',
                         help='Enable verbose mode')
 
@@ -577,6 +643,9 @@ def main():
 
     args = parser.parse_args()
 
+    if args.json and not args.query:
+        parser.error('--json requires --query')
+
     # log formatting
     logging.basicConfig(format='%(levelname)s: %(message)s')
 
@@ -585,8 +654,12 @@ def main():
         logging.getLogger().setLevel(logging.DEBUG)
 
     if args.query:
-        mode = get_current_mode()
-        print(mode)
+        if args.json:
+            from json import dumps
+            print(dumps(get_mode_status()))
+        else:
+            mode = get_current_mode()
+            print(mode)
         return
     elif args.cache_create:
         assert_root()
@@ -599,25 +672,50 @@ def main():
     elif args.cache_query:
         CachedConfig.show_cache_file()
         return
+    elif args.history:
+        SwitchHistory.show_history_file()
+        return
+    elif args.holders:
+        show_dgpu_holders()
+        return
+    elif args.watch_hotplug:
+        assert_root()
+        watch_hotplug(args)
+        return
 
     if args.switch or args.reset_sddm or args.reset:
-        with CachedConfig(args).adapter():
-            if args.switch:
-                assert_root()
-                graphics_mode_switcher(
-                    args.switch, args.dm,
-                    args.force_comp, args.coolbits, args.rtd3, args.use_nvidia_current
-                )
-            elif args.reset_sddm:
-                assert_root()
-                create_file(SDDM_XSETUP_PATH, SDDM_XSETUP_CONTENT, True)
-                print('Operation completed successfully')
-            elif args.reset:
-                assert_root()
-                cleanup()
-                CachedConfig.delete_cache_file()
-                rebuild_initramfs()
-                print('Operation completed successfully')
+        # only root can mutate the system, so only root records history
+        if os.geteuid() == 0:
+            history.start()
+        status = 1
+        try:
+            runtime_mode = get_runtime_mode(
+                get_loaded_modules(), get_nvidia_gpu_sysfs_path())
+            with CachedConfig(args).adapter():
+                if args.switch:
+                    assert_root()
+                    graphics_mode_switcher(
+                        args.switch, args.dm,
+                        args.force_comp, args.coolbits, args.rtd3, args.use_nvidia_current
+                    )
+                elif args.reset_sddm:
+                    assert_root()
+                    create_file(SDDM_XSETUP_PATH, SDDM_XSETUP_CONTENT, True)
+                    print('Operation completed successfully')
+                elif args.reset:
+                    assert_root()
+                    cleanup()
+                    CachedConfig.delete_cache_file()
+                    rebuild_initramfs()
+                    print('Operation completed successfully')
+            if args.switch or args.reset:
+                write_staged_mode(args.switch or 'hybrid', runtime_mode)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+            raise
+        finally:
+            history.record(args, status)
 
 
 class CachedConfig:
@@ -666,7 +764,11 @@ class CachedConfig:
     @staticmethod
     def delete_cache_file():
         os.remove(CACHE_FILE_PATH)
-        os.removedirs(os.path.dirname(CACHE_FILE_PATH))
+        try:
+            os.removedirs(os.path.dirname(CACHE_FILE_PATH))
+        except OSError:
+            # keep the folder if it still holds the switch history
+            pass
         logging.debug(f"Removed file {CACHE_FILE_PATH}")
 
     def read_cache_file(self):
@@ -690,6 +792,7 @@ class CachedConfig:
                 content = f.read()
         print(content)
 
+    @timed_phase('write')
     def write_cache_file(self):
         from json import dump
         os.makedirs(os.path.dirname(CACHE_FILE_PATH), exist_ok=True)
@@ -700,6 +803,138 @@ class CachedConfig:
         logging.debug(f"Created file {CACHE_FILE_PATH}")
 
 
+class SwitchHistory:
+    '''Per-phase timings of mutating operations, kept in HISTORY_FILE_PATH'''
+
+    def __init__(self) -> None:
+        self.recording = False
+        self.durations = dict.fromkeys(HISTORY_PHASES, 0.0)
+        self.active_phase = None
+
+    def start(self):
+        self.recording = True
+        self.durations = dict.fromkeys(HISTORY_PHASES, 0.0)
+        self.started = time.monotonic()
+
+    @contextmanager
+    def phase(self, name):
+        # nested phases are accounted to the outermost one
+        if self.active_phase is not None:
+            yield
+            return
+
+        self.active_phase = name
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.durations[name] += time.monotonic() - start
+            self.active_phase = None
+
+    def create_record(self, app_args, status):
+        if app_args.switch:
+            mode = app_args.switch
+        elif app_args.reset_sddm:
+            mode = 'reset-sddm'
+        else:
+            mode = 'reset'
+
+        return {
+            'time': int(time.time()),
+            'mode': mode,
+            'flags': {
+                'dm': app_args.dm,
+                'force_comp': app_args.force_comp,
+                'coolbits': app_args.coolbits,
+                'rtd3': app_args.rtd3,
+                'use_nvidia_current': app_args.use_nvidia_current
+            },
+            'durations': {phase: round(duration, 4) for phase, duration in self.durations.items()},
+            'total': round(time.monotonic() - self.started, 4),
+            'status': status,
+            'kernel': os.uname().release
+        }
+
+    def record(self, app_args, status):
+        if not self.recording:
+            return
+        self.recording = False
+
+        from json import dumps
+        line = dumps(self.create_record(app_args, status),
+                     separators=(',', ':')) + '\n'
+        try:
+            os.makedirs(os.path.dirname(HISTORY_FILE_PATH), exist_ok=True)
+            if SwitchHistory.count_records(HISTORY_FILE_PATH) >= HISTORY_MAX_RECORDS:
+                os.replace(HISTORY_FILE_PATH, HISTORY_FILE_PATH + '.1')
+            with open(HISTORY_FILE_PATH, 'a', encoding='utf-8') as f:
+                f.write(line)
+            logging.debug(f"Appended record to {HISTORY_FILE_PATH}")
+        except OSError as e:
+            logging.warning(f"Failed to write history '{HISTORY_FILE_PATH}': {e}")
+
+    @staticmethod
+    def count_records(path):
+        # one record per line, no need to parse them for rotation
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'r', encoding='utf-8') as f:
+            return sum(1 for _ in f)
+
+    @staticmethod
+    def read_records(path):
+        from json import loads
+        records = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = loads(line)
+                    except ValueError:
+                        # skip records truncated by an interrupted write
+                        continue
+                    # skip anything that is valid JSON but not a record
+                    if isinstance(record, dict) and isinstance(record.get('durations'), dict) \
+                            and all(key in record for key in HISTORY_RECORD_KEYS):
+                        records.append(record)
+        return records
+
+    @staticmethod
+    def percentile(values, percent):
+        # nearest-rank percentile
+        ordered = sorted(values)
+        rank = max(1, -(-len(ordered) * percent // 100))
+        return ordered[int(rank) - 1]
+
+    @staticmethod
+    def show_history_file():
+        records = SwitchHistory.read_records(HISTORY_FILE_PATH + '.1') + \
+            SwitchHistory.read_records(HISTORY_FILE_PATH)
+        if len(records) == 0:
+            print(f'ERROR: Could not read {HISTORY_FILE_PATH}')
+            return
+
+        print(f"{'MODE':<12}{'PHASE':<12}{'RUNS':>6}{'P50 (s)':>10}{'P95 (s)':>10}")
+        for mode in sorted(set(record['mode'] for record in records)):
+            runs = [record for record in records if record['mode'] == mode]
+            for phase in HISTORY_PHASES + ['total']:
+                if phase == 'total':
+                    values = [record['total'] for record in runs]
+                else:
+                    values = [record['durations'].get(phase, 0.0) for record in runs]
+                print(f"{mode:<12}{phase:<12}{len(values):>6}"
+                      f"{SwitchHistory.percentile(values, 50):>10.3f}"
+                      f"{SwitchHistory.percentile(values, 95):>10.3f}")
+
+        failed = sum(1 for record in records if record['status'] != 0)
+        kernels = sorted(set(record['kernel'] for record in records))
+        print(f"Failed operations: {failed}/{len(records)}")
+        print(f"Kernels: {', '.join(kernels)}")
+
+
+history = SwitchHistory()
+
+
 def get_current_mode():
     mode = 'hybrid'
     if os.path.exists(BLACKLIST_PATH) and (os.path.exists(UDEV_INTEGRATED_PATH) or os.path.exists('/lib/udev/rules.d/50-remove-nvidia.rules')):
@@ -709,5 +944,379 @@ def get_current_mode():
     return mode
 
 
+def read_sysfs_attr(path):
+    # plain reads of sysfs attributes never resume a runtime suspended device
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_nvidia_gpu_sysfs_paths():
+    # passive alternative to get_nvidia_gpu_pci_bus, no lspci involved
+    try:
+        devices = sorted(os.listdir(PCI_DEVICES_PATH))
+    except OSError:
+        return []
+    device_paths = []
+    for device in devices:
+        device_path = os.path.join(PCI_DEVICES_PATH, device)
+        pci_class = read_sysfs_attr(os.path.join(device_path, 'class'))
+        if read_sysfs_attr(os.path.join(device_path, 'vendor')) == NVIDIA_PCI_VENDOR \
+                and pci_class is not None and pci_class.startswith('0x03'):
+            device_paths.append(device_path)
+    return device_paths
+
+
+def get_nvidia_gpu_sysfs_path():
+    device_paths = get_nvidia_gpu_sysfs_paths()
+    return device_paths[0] if device_paths else None
+
+
+def get_loaded_modules():
+    try:
+        with open(PROC_MODULES_PATH, 'r', encoding='utf-8') as f:
+            return {line.split()[0] for line in f if line.strip()}
+    except OSError:
+        return set()
+
+
+def read_staged_mode():
+    from json import loads
+    try:
+        with open(STAGED_FILE_PATH, 'r', encoding='utf-8') as f:
+            staged = loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(staged, dict) or not all(key in staged for key in ['mode', 'boot_id', 'booted_mode']):
+        return None
+    return staged
+
+
+def write_staged_mode(mode, runtime_mode):
+    # remember which mode this boot runs in, so that switching back to it
+    # before rebooting no longer counts as a pending reboot
+    from json import dumps
+    boot_id = read_sysfs_attr(BOOT_ID_PATH)
+    staged = read_staged_mode()
+    if staged is None:
+        # None when the running mode cannot be told passively
+        booted_mode = runtime_mode
+    elif staged['boot_id'] == boot_id:
+        booted_mode = staged['booted_mode']
+    else:
+        booted_mode = staged['mode']
+    create_file(STAGED_FILE_PATH, dumps({
+        'mode': mode,
+        'boot_id': boot_id,
+        'booted_mode': booted_mode
+    }, indent=4) + '\n')
+
+
+def get_recorded_mode(staged, boot_id):
+    # the mode this boot started in according to staged.json
+    if staged is None:
+        return None
+    if staged['boot_id'] == boot_id:
+        return staged['booted_mode']
+    return staged['mode']
+
+
+def is_reboot_pending(staged, boot_id, configured_mode, effective_mode, runtime_mode):
+    if staged is not None and staged['boot_id'] == boot_id:
+        booted_mode = staged['booted_mode'] or runtime_mode
+        # a switch happened this boot from an unknown mode
+        if booted_mode is None:
+            return True
+        return staged['mode'] != booted_mode
+    # no switch this boot, e.g. switched before staged.json existed or files
+    # changed by hand
+    if configured_mode is None or effective_mode is None:
+        return False
+    return configured_mode != effective_mode
+
+
+def get_drm_devices_driving_displays():
+    # the 'enabled' attribute of a connector is cached state, reading it
+    # does not trigger a probe of the display
+    devices = set()
+    try:
+        entries = os.listdir(DRM_CLASS_PATH)
+    except OSError:
+        return devices
+    for entry in entries:
+        if not entry.startswith('card') or '-' not in entry:
+            continue
+        if read_sysfs_attr(os.path.join(DRM_CLASS_PATH, entry, 'enabled')) == 'enabled':
+            card = entry.split('-')[0]
+            devices.add(os.path.realpath(
+                os.path.join(DRM_CLASS_PATH, card, 'device')))
+    return devices
+
+
+def get_runtime_mode(modules, device_path):
+    # inferred from runtime state only, None when it cannot be told passively
+    if device_path is None or not any(module in modules for module in NVIDIA_KERNEL_MODULES + ['nouveau']):
+        return 'integrated'
+    if not any(module in modules for module in NVIDIA_KERNEL_MODULES):
+        # EnvyControl only sets up nvidia mode for the proprietary driver
+        return 'hybrid'
+    if read_sysfs_attr(os.path.join(device_path, 'power', 'runtime_status')) == 'suspended':
+        # the X server keeps the dGPU busy in nvidia mode
+        return 'hybrid'
+    driving_devices = get_drm_devices_driving_displays()
+    if driving_devices == {os.path.realpath(device_path)}:
+        return 'nvidia'
+    return None
+
+
+def get_mode_status():
+    # built from /proc and sysfs only; nvidia-smi or lspci would wake the dGPU
+    device_path = get_nvidia_gpu_sysfs_path()
+    staged = read_staged_mode()
+    boot_id = read_sysfs_attr(BOOT_ID_PATH)
+    configured_mode = get_current_mode()
+    runtime_mode = get_runtime_mode(get_loaded_modules(), device_path)
+    # runtime state overrides the record when it is conclusive
+    effective_mode = runtime_mode or get_recorded_mode(staged, boot_id)
+
+    dgpu = None
+    if device_path is not None:
+        driver_path = os.path.join(device_path, 'driver')
+        dgpu = {
+            'pci_bus': os.path.basename(device_path),
+            'driver': os.path.basename(os.readlink(driver_path)) if os.path.islink(driver_path) else None,
+            'runtime_status': read_sysfs_attr(os.path.join(device_path, 'power', 'runtime_status')),
+            'power_state': read_sysfs_attr(os.path.join(device_path, 'power_state'))
+        }
+
+    return {
+        'configured_mode': configured_mode,
+        'effective_mode': effective_mode,
+        'reboot_pending': is_reboot_pending(staged, boot_id, configured_mode, effective_mode, runtime_mode),
+        'dgpu': dgpu
+    }
+
+
+def get_dgpu_drm_nodes(device_path):
+    # map the dGPU to its /dev/dri card and render nodes through sysfs
+    nodes = set()
+    try:
+        entries = os.listdir(DRM_CLASS_PATH)
+    except OSError:
+        return nodes
+    device_path = os.path.realpath(device_path)
+    for entry in entries:
+        # skip connectors such as card1-HDMI-A-1
+        if not (entry.startswith('card') or entry.startswith('renderD')) or '-' in entry:
+            continue
+        if os.path.realpath(os.path.join(DRM_CLASS_PATH, entry, 'device')) == device_path:
+            nodes.add(f'/dev/dri/{entry}')
+    return nodes
+
+
+def get_dgpu_holders(drm_nodes):
+    # one scandir per process and one readlink per fd; the fd targets are
+    # compared as strings so no symlink is ever resolved a second time
+    holders = {}
+    with os.scandir('/proc') as procs:
+        for proc in procs:
+            if not proc.name.isdigit():
+                continue
+            devices = set()
+            try:
+                with os.scandir(f'/proc/{proc.name}/fd') as fds:
+                    for fd in fds:
+                        try:
+                            target = os.readlink(fd.path)
+                        except OSError:
+                            continue
+                        if target.startswith('/dev/nvidia') or target in drm_nodes:
+                            devices.add(target)
+            except OSError:
+                # process exited or belongs to another user
+                continue
+            if devices:
+                holders[int(proc.name)] = devices
+    return holders
+
+
+def get_process_cmdline(pid):
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            cmdline = f.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip()
+        if cmdline:
+            return cmdline
+        with open(f'/proc/{pid}/comm', 'r', encoding='utf-8') as f:
+            return f'[{f.read().strip()}]'
+    except OSError:
+        return '?'
+
+
+def show_dgpu_holders():
+    device_path = get_nvidia_gpu_sysfs_path()
+    if device_path is None:
+        logging.error("Could not find Nvidia GPU")
+        sys.exit(1)
+
+    runtime_status = read_sysfs_attr(os.path.join(device_path, 'power', 'runtime_status'))
+    print(f"Nvidia dGPU {os.path.basename(device_path)} runtime_status: {runtime_status}")
+
+    if os.geteuid() != 0:
+        logging.warning(
+            "Processes of other users are hidden without root privileges")
+
+    holders = get_dgpu_holders(get_dgpu_drm_nodes(device_path))
+    if len(holders) == 0:
+        print('No processes hold the Nvidia dGPU open')
+        return
+
+    print(f"{'PID':<8}{'DEVICES':<32} COMMAND")
+    for pid in sorted(holders):
+        print(f"{pid:<8}{','.join(sorted(holders[pid])):<32} {get_process_cmdline(pid)}")
+
+
+def parse_uevent(data):
+    # kernel uevents are 'ACTION@DEVPATH' followed by NUL separated KEY=VALUE pairs
+    fields = data.decode('utf-8', 'replace').split('\0')
+    event = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition('=')
+        if sep:
+            event[key] = value
+    return event
+
+
+def is_nvidia_gpu_uevent(event):
+    # PCI_CLASS is the hexadecimal class code without leading zeros, e.g. 30000
+    return event.get('SUBSYSTEM') == 'pci' \
+        and event.get('PCI_ID', '').upper().startswith('10DE:') \
+        and event.get('PCI_CLASS', '').startswith('3')
+
+
+def get_cached_nvidia_gpu_pci_bus():
+    from json import loads
+    try:
+        with open(CACHE_FILE_PATH, 'r', encoding='utf-8') as f:
+            return loads(f.read())['nvidia_gpu_pci_bus']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def select_nvidia_gpu_pci_slot(present_pci_slot_names, added_pci_slot_names):
+    # the most recently added GPU wins, then the cached one, then the first
+    for pci_slot_name in reversed(added_pci_slot_names):
+        if pci_slot_name in present_pci_slot_names:
+            return pci_slot_name
+    cached_pci_bus = get_cached_nvidia_gpu_pci_bus()
+    for pci_slot_name in present_pci_slot_names:
+        if format_pci_bus_id(pci_slot_name) == cached_pci_bus:
+            return pci_slot_name
+    return present_pci_slot_names[0] if present_pci_slot_names else None
+
+
+def update_nvidia_gpu_pci_bus(app_args, nvidia_gpu_pci_bus):
+    # only touch the cache and the BusID of the X.org config, no initramfs rebuild
+    cached_config = CachedConfig(app_args)
+    if cached_config.current_mode == 'integrated':
+        # the udev rules remove the GPU again right after it is added
+        logging.info("Ignoring Nvidia GPU hotplug in integrated mode")
+        return
+
+    if get_cached_nvidia_gpu_pci_bus() != nvidia_gpu_pci_bus:
+        cached_config.obj = cached_config.create_cache_obj(nvidia_gpu_pci_bus)
+        try:
+            cached_config.write_cache_file()
+        except OSError as e:
+            logging.error(f"Failed to update cache '{CACHE_FILE_PATH}': {e}")
+            return
+        print(f"Updated cached Nvidia GPU BusID to {nvidia_gpu_pci_bus}")
+
+    # never touch an X.org config that EnvyControl did not generate
+    if cached_config.current_mode == 'nvidia':
+        try:
+            with open(XORG_PATH, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except OSError as e:
+            logging.error(f"Failed to read file '{XORG_PATH}': {e}")
+            return
+        if not content.startswith('# Automatically generated by EnvyControl'):
+            return
+        new_content = re.sub(XORG_NVIDIA_BUS_ID_PATTERN,
+                             lambda match: match.group(1) + nvidia_gpu_pci_bus + match.group(2), content)
+        if new_content != content:
+            create_file(XORG_PATH, new_content)
+            print(f"Updated BusID in {XORG_PATH} to {nvidia_gpu_pci_bus}")
+
+
+def watch_hotplug(app_args):
+    import socket
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    # a bigger receive buffer keeps bursts of dock events from being dropped
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.bind((0, UEVENT_KERNEL_GROUP))
+    print('Watching for Nvidia GPU hotplug events')
+
+    # GPUs seen in add events, most recent last
+    added_pci_slot_names = []
+
+    def sync_from_sysfs(removed_pci_slot_name=None):
+        # the sysfs entry of a removed device may outlive its remove event
+        present_pci_slot_names = [os.path.basename(device_path) for device_path in get_nvidia_gpu_sysfs_paths()
+                                  if os.path.basename(device_path) != removed_pci_slot_name]
+        pci_slot_name = select_nvidia_gpu_pci_slot(
+            present_pci_slot_names, added_pci_slot_names)
+        if pci_slot_name is not None:
+            update_nvidia_gpu_pci_bus(
+                app_args, format_pci_bus_id(pci_slot_name))
+
+    # the GPU may have moved while nobody was watching
+    sync_from_sysfs()
+
+    try:
+        while True:
+            try:
+                data, (sender_pid, _) = sock.recvfrom(UEVENT_BUFFER_SIZE)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                logging.warning("Dropped uevents, rescanning PCI devices")
+                sync_from_sysfs()
+                continue
+
+            # only the kernel may tell a root process what to write
+            if sender_pid != 0:
+                continue
+
+            event = parse_uevent(data)
+            if not is_nvidia_gpu_uevent(event):
+                continue
+
+            action = event.get('ACTION')
+            pci_slot_name = event.get('PCI_SLOT_NAME', '')
+            if not re.match(PCI_SLOT_NAME_PATTERN, pci_slot_name):
+                logging.warning(f"Ignoring uevent with invalid PCI_SLOT_NAME '{pci_slot_name}'")
+                continue
+
+            if action == 'add':
+                print(f"Nvidia GPU added at {pci_slot_name}")
+                if pci_slot_name in added_pci_slot_names:
+                    added_pci_slot_names.remove(pci_slot_name)
+                added_pci_slot_names.append(pci_slot_name)
+                sync_from_sysfs()
+            elif action == 'remove':
+                print(f"Nvidia GPU removed from {pci_slot_name}")
+                if pci_slot_name in added_pci_slot_names:
+                    added_pci_slot_names.remove(pci_slot_name)
+                # retarget a remaining Nvidia GPU, otherwise keep the cache so
+                # the GPU can be switched to while unplugged
+                sync_from_sysfs(pci_slot_name)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+
 if __name__ == '__main__':
     main()